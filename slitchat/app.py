@@ -1,11 +1,38 @@
-import json
-import subprocess
+import re
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+import orjson
 import streamlit as st
-import requests
-from typing import List, Dict, Optional, Tuple
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    import requests
 
 # Configuration
 OLLAMA_BASE_URL = "http://localhost:11434"
+# Keep the model loaded between turns and fix the context window so
+# Ollama can reuse its prompt cache across a conversation
+KEEP_ALIVE = "30m"
+NUM_CTX = 4096
+# Upper bounds on the chat history resent to Ollama each turn; the token
+# budget leaves a quarter of the context window for the reply
+MAX_HISTORY_MSGS = 32
+MAX_HISTORY_TOKENS = NUM_CTX * 3 // 4
+# Minimum seconds between streamed UI updates (~20 Hz)
+RENDER_INTERVAL = 0.05
+# Seconds to wait for a pending model fetch before polling again
+MODELS_POLL_INTERVAL = 0.5
+
+# Request headers: Ollama's JSONL stream is uncompressed, so skip gzip
+# negotiation and keep the connection open between turns
+HEADERS = {
+    "Accept-Encoding": "identity",
+    "Connection": "keep-alive",
+    "Content-Type": "application/json",
+}
+
+# Chat command for setting the system prompt: /set system """prompt text"""
+_SET_SYS_RE = re.compile(r'^/set\s+system\s+"""(.*?)"""\s*$', re.S)
 
 # App title
 st.set_page_config(
@@ -14,26 +41,74 @@ st.set_page_config(
     layout="wide",
 )
 
-def get_ollama_models() -> List[str]:
-    """Fetch available models from Ollama using CLI command"""
-    try:
-        result = subprocess.run(
-            ["ollama", "list"], 
-            capture_output=True, 
-            text=True, 
-            check=True
-        )
-        lines = result.stdout.strip().split('\n')
-        # Skip header line
-        models = []
-        for line in lines[1:]:
-            if line.strip():
-                # First word in each line is the model name
-                models.append(line.split()[0])
-        return models
-    except Exception as e:
-        st.error(f"Error fetching models: {str(e)}")
-        return []
+@st.cache_resource(show_spinner=False)
+def get_session() -> "requests.Session":
+    """Return a shared HTTP session so connections to Ollama are kept alive"""
+    # Imported lazily: requests/urllib3 are slow to import and are not
+    # needed until the first request to Ollama
+    import requests
+    from requests.adapters import HTTPAdapter
+    
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+    session.mount("http://", adapter)
+    return session
+
+@st.cache_resource(show_spinner=False)
+def get_executor() -> ThreadPoolExecutor:
+    """Return a shared worker pool for blocking calls kept off the script thread"""
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="slitchat")
+
+def get_ollama_models(session: "requests.Session") -> List[str]:
+    """Fetch available models from the Ollama API"""
+    resp = session.get(f"{OLLAMA_BASE_URL}/api/tags", timeout=2)
+    resp.raise_for_status()
+    return [m["name"] for m in resp.json().get("models", [])]
+
+@st.cache_resource(ttl=60, show_spinner=False)
+def get_models_future() -> "Future[List[str]]":
+    """Start fetching models in the background and cache the pending result"""
+    # Resolve the cached resources here; the worker thread has no Streamlit
+    # script context to call them from
+    return get_executor().submit(get_ollama_models, get_session())
+
+def iter_jsonl(response: "requests.Response", chunk_size: int = 65536) -> Iterator[bytes]:
+    """Yield non-empty lines from a streamed JSONL response using large reads"""
+    raw = response.raw
+    raw.decode_content = False
+    if hasattr(raw, "read1"):
+        # Read whatever is available straight from the socket (urllib3 >= 2.3)
+        chunks = iter(lambda: raw.read1(chunk_size), b"")
+    else:
+        chunks = response.iter_content(chunk_size=chunk_size)
+    buf = b""
+    for chunk in chunks:
+        buf += chunk
+        start = 0
+        while (nl := buf.find(b"\n", start)) != -1:
+            if nl > start:
+                yield buf[start:nl]
+            start = nl + 1
+        buf = buf[start:]
+    if buf.strip():
+        yield buf
+
+def trim_history(messages: List[Dict]) -> List[Dict]:
+    """Return the most recent messages that fit the history limits"""
+    tail = messages[-MAX_HISTORY_MSGS:]
+    # Rough token estimate of ~4 characters per token
+    budget = MAX_HISTORY_TOKENS
+    start = len(tail)
+    while start > 0:
+        cost = len(tail[start - 1]["content"]) // 4
+        if cost > budget and start < len(tail):
+            break
+        budget -= cost
+        start -= 1
+    # Don't open the window halfway through a turn
+    while start < len(tail) - 1 and tail[start]["role"] == "assistant":
+        start += 1
+    return tail[start:]
 
 def send_message(model: str, messages: List[Dict], system_prompt: Optional[str] = None, stream: bool = True) -> Tuple[str, bool]:
     """Send message to Ollama API and return response"""
@@ -43,6 +118,8 @@ def send_message(model: str, messages: List[Dict], system_prompt: Optional[str]
         "model": model,
         "messages": messages,
         "stream": stream,
+        "keep_alive": KEEP_ALIVE,
+        "options": {"num_ctx": NUM_CTX},
     }
     
     # Add system prompt if provided
@@ -50,28 +127,25 @@ def send_message(model: str, messages: List[Dict], system_prompt: Optional[str]
         payload["system"] = system_prompt
     
     if stream:
-        response_text = ""
-        is_error = False
-        
         try:
-            with requests.post(url, json=payload, stream=True) as response:
+            # Serialize with orjson; HEADERS already carries the JSON content type
+            body = orjson.dumps(payload)
+            with get_session().post(url, data=body, headers=HEADERS, stream=True) as response:
                 response.raise_for_status()
                 
-                for line in response.iter_lines():
-                    if line:
-                        try:
-                            chunk = json.loads(line)
-                            if "message" in chunk and "content" in chunk["message"]:
-                                content = chunk["message"]["content"]
-                                response_text += content
-                                yield response_text, False
-                        except json.JSONDecodeError:
-                            continue
+                for line in iter_jsonl(response):
+                    try:
+                        chunk = orjson.loads(line)
+                        if "message" in chunk and "content" in chunk["message"]:
+                            yield chunk["message"]["content"], False
+                    except orjson.JSONDecodeError:
+                        continue
         except Exception as e:
             yield str(e), True
     else:
         try:
-            response = requests.post(url, json=payload)
+            body = orjson.dumps(payload)
+            response = get_session().post(url, data=body, headers=HEADERS)
             response.raise_for_status()
             data = response.json()
             if "message" in data and "content" in data["message"]:
@@ -81,6 +155,36 @@ def send_message(model: str, messages: List[Dict], system_prompt: Optional[str]
         except Exception as e:
             return str(e), True
 
+@st.fragment
+def stream_reply(model: str, messages: List[Dict], system_prompt: Optional[str] = None):
+    """Stream the assistant reply in its own fragment and record it in the history"""
+    with st.chat_message("assistant"):
+        message_placeholder = st.empty()
+        
+        # Stream the response, collecting the deltas and joining them only
+        # when the placeholder is redrawn
+        parts: List[str] = []
+        is_error = False
+        last_render = 0.0
+        for response_chunk, is_error in send_message(model, messages, system_prompt, stream=True):
+            if is_error:
+                st.error(response_chunk)
+                break
+            else:
+                parts.append(response_chunk)
+                # Coalesce token updates to a fixed cadence
+                now = time.monotonic()
+                if now - last_render >= RENDER_INTERVAL:
+                    message_placeholder.markdown("".join(parts) + "▌")
+                    last_render = now
+        
+        # Final update without cursor
+        if not is_error:
+            full_response = "".join(parts)
+            message_placeholder.markdown(full_response)
+            # Add assistant response to chat history
+            st.session_state.messages.append({"role": "assistant", "content": full_response})
+
 def main():
     # App header
     st.title("SlitChat - Chat with Ollama Models")
@@ -95,14 +199,32 @@ def main():
     if "system_prompt" not in st.session_state:
         st.session_state.system_prompt = ""
     
+    if "available_models" not in st.session_state:
+        st.session_state.available_models = None
+    
     # Sidebar for model selection
     with st.sidebar:
         st.header("Model Selection")
         
-        # Fetch available models
-        available_models = get_ollama_models()
+        # Fetch available models in the background (cached; refresh on demand)
+        if st.button("Refresh models"):
+            get_models_future.clear()
+        # Keep showing the last fetched list while a refresh is pending
+        models_future = get_models_future()
+        if models_future.done():
+            try:
+                st.session_state.available_models = models_future.result()
+            except Exception as e:
+                st.error(f"Error fetching models: {str(e)}")
+                if st.session_state.available_models is None:
+                    st.session_state.available_models = []
+                # Retry on the next rerun instead of caching the failure
+                get_models_future.clear()
+        available_models = st.session_state.available_models
         
-        if available_models:
+        if available_models is None:
+            st.info("Loading models…")
+        elif available_models:
             selected_model = st.selectbox(
                 "Choose a model",
                 options=available_models,
@@ -156,28 +278,20 @@ def main():
         if user_input:
             # Check for system prompt command
             if user_input.startswith("/set system"):
-                try:
-                    # Extract the system prompt from the command
-                    # Format: /set system """prompt text"""
-                    prompt_start = user_input.find('"""', 12)
-                    if prompt_start != -1:
-                        prompt_end = user_input.find('"""', prompt_start + 3)
-                        if prompt_end != -1:
-                            new_system_prompt = user_input[prompt_start + 3:prompt_end]
-                            st.session_state.system_prompt = new_system_prompt
-                            
-                            # Add system message to chat
-                            with st.chat_message("system"):
-                                st.markdown(f"System prompt updated to: *{new_system_prompt}*")
-                            
-                            # No need to add this to the actual message history
-                            st.rerun()
-                        else:
-                            st.error("Invalid system prompt format. Use: /set system \"\"\"Your prompt here\"\"\"")
-                    else:
-                        st.error("Invalid system prompt format. Use: /set system \"\"\"Your prompt here\"\"\"")
-                except Exception as e:
-                    st.error(f"Error setting system prompt: {str(e)}")
+                match = _SET_SYS_RE.match(user_input)
+                if match:
+                    new_system_prompt = match.group(1)
+                    st.session_state.system_prompt = new_system_prompt
+                    
+                    # Add system message to chat
+                    with st.chat_message("system"):
+                        st.markdown(f"System prompt updated to: *{new_system_prompt}*")
+                    
+                    # No need to add this to the actual message history, and no
+                    # rerun either: the sidebar picks up the new prompt on the
+                    # next natural rerun
+                else:
+                    st.error("Invalid system prompt format. Use: /set system \"\"\"Your prompt here\"\"\"")
             else:
                 # Add user message to chat
                 st.session_state.messages.append({"role": "user", "content": user_input})
@@ -187,37 +301,19 @@ def main():
                     st.markdown(user_input)
                 
                 # Display assistant response with streaming
-                with st.chat_message("assistant"):
-                    message_placeholder = st.empty()
-                    
-                    # Prepare messages for API
-                    api_messages = [
-                        {"role": msg["role"], "content": msg["content"]} 
-                        for msg in st.session_state.messages
-                    ]
-                    
-                    # Stream the response
-                    full_response = ""
-                    for response_chunk, is_error in send_message(
-                        st.session_state.selected_model, 
-                        api_messages,
-                        st.session_state.system_prompt if st.session_state.system_prompt else None,
-                        stream=True
-                    ):
-                        if is_error:
-                            st.error(response_chunk)
-                            break
-                        else:
-                            full_response = response_chunk
-                            message_placeholder.markdown(full_response + "▌")
-                    
-                    # Final update without cursor
-                    if not is_error:
-                        message_placeholder.markdown(full_response)
-                        # Add assistant response to chat history
-                        st.session_state.messages.append({"role": "assistant", "content": full_response})
+                stream_reply(
+                    st.session_state.selected_model,
+                    trim_history(st.session_state.messages),
+                    st.session_state.system_prompt if st.session_state.system_prompt else None,
+                )
     else:
         st.info("Please select a model from the sidebar to start chatting.")
+    
+    # While a model fetch is pending, poll for it and rerun so the sidebar
+    # picks up the result (the last list stays visible in the meantime)
+    if not models_future.done():
+        wait([models_future], timeout=MODELS_POLL_INTERVAL)
+        st.rerun()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file